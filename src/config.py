@@ -3,14 +3,29 @@ import os
 
 load_dotenv()
 
-AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "")
-AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY", "")
-AZURE_OPENAI_DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "")
-AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "")
-AZURE_OPENAI_MODEL_NAME = os.getenv("AZURE_OPENAI_MODEL_NAME", "")
 
-REPROMPTING = os.getenv("REPROMPTING", "true").casefold() == "true"
-MAX_PROMPTS = int(os.getenv("MAX_PROMPTS", "2"))
+_TRUE_VALUES = frozenset({"1", "true", "yes", "on"})
 
-CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1024))
-CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 128))
\ No newline at end of file
+def _env_bool(key: str, default: str) -> bool:
+    """Read a boolean flag from the environment."""
+    return os.environ.get(key, default).strip().lower() in _TRUE_VALUES
+
+def _env_int(key: str, default: int) -> int:
+    """Read an integer setting from the environment."""
+    return int(os.environ.get(key, default))
+
+
+AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT", "")
+AZURE_OPENAI_API_KEY = os.environ.get("AZURE_OPENAI_API_KEY", "")
+AZURE_OPENAI_DEPLOYMENT_NAME = os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME", "")
+AZURE_OPENAI_API_VERSION = os.environ.get("AZURE_OPENAI_API_VERSION", "")
+AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME", "")
+
+REPROMPTING = _env_bool("REPROMPTING", "true")
+MAX_PROMPTS = _env_int("MAX_PROMPTS", 2)
+BATCH_SIZE = max(1, _env_int("BATCH_SIZE", 8))
+MAX_CONCURRENCY = max(1, _env_int("MAX_CONCURRENCY", 16))
+MAX_RETRIES = _env_int("MAX_RETRIES", 5)
+
+CHUNK_SIZE = _env_int("CHUNK_SIZE", 1024)
+CHUNK_OVERLAP = _env_int("CHUNK_OVERLAP", 128)
\ No newline at end of file
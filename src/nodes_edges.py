@@ -1,16 +1,47 @@
+from collections import defaultdict
+from langchain_core.messages import HumanMessage
 from langgraph.types import Send
-from typing import Literal
-import json
-
-from src.config import MAX_PROMPTS, REPROMPTING
+from typing import Any, Dict, List, Literal
+import asyncio
+import hashlib
+import io
+import logging
+import orjson
+import weakref
+
+from src.config import BATCH_SIZE, MAX_CONCURRENCY, MAX_PROMPTS, REPROMPTING
 from src.oifile import OIFile
-from src.prompts import map_prompt, reduce_prompt
+from src.prompts import combination_prompt_template, system_message, user_prompt_template
 from src.states import OverallState, InputState, OutputState, DetectState, LoadState, MaskState, ReduceState, SplitState
-from src.utils import chunk_document, get_llm, get_logger, mask_text_with_normalization, pii_exist_in_text
+from src.utils import build_pii_pattern, chunk_document, get_llm, get_logger, mask_text_with_normalization, pii_exist_in_text, strip_json_fence
+
 
+# Run of asterisks that marks PII text masked out before reprompting
+_MASK_MARKER = '****'
 
 logger = get_logger()
 
+# Caps the LLM requests in flight across all parallel graph branches, so a wide
+# fan-out does not run into the provider's rate limits and its retry backoff.
+# A semaphore is bound to the event loop it first waits on, so each running
+# loop gets its own, dropped together with the loop.
+_llm_semaphores = weakref.WeakKeyDictionary()
+
+
+def _get_llm_semaphore() -> asyncio.Semaphore:
+    """Get the LLM concurrency semaphore of the running event loop."""
+    loop = asyncio.get_running_loop()
+    semaphore = _llm_semaphores.get(loop)
+
+    if semaphore is None:
+        semaphore = _llm_semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    return semaphore
+
+async def _invoke_llm(messages: list) -> Any:
+    """Send a single request to the LLM once a concurrency slot is free."""
+    async with _get_llm_semaphore():
+        return await get_llm().ainvoke(messages)
 
 async def _map_input(state: InputState) -> LoadState:
     """Map input files to load_document state."""
@@ -36,7 +67,7 @@ async def _load_document(state: LoadState) -> OverallState:
         if file and isinstance(file, dict) and "file" in file:
             file_info = file["file"]
 
-            logger.debug(f"Loading document {file_info.get('filename', '')}...")
+            logger.debug("Loading document %s...", file_info.get('filename', ''))
 
             if file_info.get('data', {}).get('content', ''):
                 results.append(OIFile(
@@ -75,7 +106,7 @@ async def _split_document(state: SplitState) -> OverallState:
     file = state.get('document', None)
 
     if file:
-        logger.debug(f"Splitting document {file.get_name()}")
+        logger.debug("Splitting document %s", file.get_name())
 
         chunks = await chunk_document(file)
 
@@ -91,91 +122,156 @@ async def _split_document(state: SplitState) -> OverallState:
 
     return {'document_chunks': results}
 
-async def _map_chunks(state: OverallState) -> DetectState:
-    """Map document chunks to identify_pii_items state."""
-    sends = []
+def _chunk_key(file_id: str, content: str) -> str:
+    """Key a document chunk by its document ID and a digest of its text."""
+    return f"{file_id}:{hashlib.blake2b(content.encode(), digest_size=16).hexdigest()}"
 
+async def _map_chunks(state: OverallState) -> DetectState:
+    """Map document chunks to identify_pii_items state, skipping chunks already sent to the LLM."""
     n_prompts = state.get("n_prompts", 0)
     files_chunks = state.get('document_chunks', {})
+    prompted_chunks = set(state.get('prompted_chunks', []))
+
+    logger.debug("_map_chunks: Received %d documents", len(files_chunks))
 
-    logger.debug(f"_map_chunks: Received {len(files_chunks)} documents")
+    # Coalesce identical chunks (e.g. repeated headers, footers or disclaimers) into one
+    # LLM call, remembering every document that contains them
+    chunk_owners = {}
 
     for file_id, chunks in files_chunks.items():
         if chunks:
             for content in chunks:
-                if content.strip():
-                    # Create Send objects with document index metadata
-                    sends.append(
-                        Send("identify_pii_items",
-                            {
-                                "n_prompts": n_prompts,
-                                "document_id": file_id,
-                                "content": content,
-                            }
-                        )
-                    )
+                # Skip empty and whitespace-only chunks, which would only cost an LLM call, and
+                # chunks an earlier round already sent unchanged (documents without masked chunks
+                # keep their lists in document_chunks, and masking can leave a chunk as it was)
+                if content and not content.isspace() and _chunk_key(file_id, content) not in prompted_chunks:
+                    chunk_owners.setdefault(content, {})[file_id] = None
 
-    return sends
+    chunk_entries = list(chunk_owners.items())
+
+    if not chunk_entries and n_prompts:
+        logger.info("No changed chunks left to reprompt --> Skipping to postprocessing of PII items.")
+        return "postprocess_pii_items"
+
+    # Pack up to BATCH_SIZE distinct chunks into each Send, so each task issues one batched LLM call
+    return [
+        Send("identify_pii_items",
+            {
+                "n_prompts": n_prompts,
+                "document_ids": [list(file_ids) for _, file_ids in chunk_entries[start:start + BATCH_SIZE]],
+                "contents": [content for content, _ in chunk_entries[start:start + BATCH_SIZE]],
+            }
+        )
+        for start in range(0, len(chunk_entries), BATCH_SIZE)
+    ]
+
+def _is_pii_item(item: Any) -> bool:
+    """Check that an LLM output item is a PII item with a non-empty text string."""
+    return isinstance(item, dict) and isinstance(item.get('text'), str) and bool(item['text'])
 
 async def _identify_pii_items(state: DetectState) -> OverallState:
-    """Identify PII items in the provided document content using an LLM."""
+    """Identify PII items in a batch of document chunks using an LLM."""
     results = {}
 
     n_prompts = state.get("n_prompts", 0)
-    file_id = state.get("document_id", "")
-    text = state.get("content", "")
-
-    if file_id and text:
-        try:
-            logger.debug(f"Identifying PII items in a chunk from document {file_id} with content {text[:100]}...")
-
-            prompt = await map_prompt.ainvoke({'text': text})
-            llm = await get_llm()
-            response = await llm.ainvoke(prompt)
-            content = response.content
+    files_ids = state.get("document_ids", [])
+    texts = state.get("contents", [])
+
+    prompted_chunks = []
+
+    if files_ids and texts:
+        logger.debug("Identifying PII items in a batch of %d chunks", len(texts))
+
+        prompts = [
+            [system_message, HumanMessage(content=user_prompt_template.format(text=text))]
+            for text in texts
+        ]
+        responses = await asyncio.gather(*(_invoke_llm(prompt) for prompt in prompts), return_exceptions=True)
+
+        for file_ids, text, response in zip(files_ids, texts, responses):
+            if isinstance(response, Exception):
+                logger.error(f"Failed to identify PII items in a chunk from documents with IDs {file_ids}.")
+                continue
+
+            try:
+                pii = orjson.loads(strip_json_fence(response.content))
+            except orjson.JSONDecodeError as e:
+                logger.warning(f"No PII items identified in a chunk from documents {file_ids} with content {text[:100]}")
+                continue
+            except Exception as e:
+                # e.g. a response whose content is not a string; only this chunk is skipped
+                logger.error(f"Failed to identify PII items in a chunk from documents with IDs {file_ids}.")
+                continue
+
+            # Remember the chunk as answered, so later rounds do not send it again unless masking changes it
+            prompted_chunks.extend(_chunk_key(file_id, text) for file_id in file_ids)
+
+            # Keep only well-formed items, so their texts can be matched as strings later
+            if isinstance(pii, list):
+                pii = [item for item in pii if _is_pii_item(item)]
 
-            if content.startswith("```json\n") and content.endswith("\n```"):
-                content = content.replace("```json\n", "").replace("\n```", "").strip()
+            if pii and isinstance(pii, list):
+                # Attribute the chunk's PII items to every document that contains the chunk
+                results.setdefault("document_ids", []).extend(file_ids)
+                results.setdefault("partial_pii_items", []).extend([pii] * len(file_ids))
 
-                pii = json.loads(content)
+                logger.info(f"Identified {len(pii)} PII items in a chunk from documents with IDs {file_ids}.")
 
-                if pii and isinstance(pii, list):
-                    results.update({
-                        "n_prompts": n_prompts + 1,
-                        "document_ids": [file_id],
-                        "partial_pii_items": [content],
-                    })
+        if results:
+            results["n_prompts"] = n_prompts + 1
 
-                    logger.info(f"Identified {len(pii)} PII items in a chunk from document with ID {file_id}.")
-        except json.JSONDecodeError as e:
-            logger.warning(f"No PII items identified in a chunk from document {file_id} with content {text[:100]}")
-        except Exception as e:
-                logger.error(f"Failed to identify PII items in a chunk from a document with ID {file_id}.")
+        if prompted_chunks:
+            results["prompted_chunks"] = prompted_chunks
 
     return results
 
+def _collect_pii_texts(partial_pii_items: List[List[Dict[str, Any]]]) -> List[str]:
+    """Flatten the partial PII lists of a document into the unique texts of its PII items."""
+    return list(dict.fromkeys(
+        item['text'] for items in partial_pii_items for item in items if _is_pii_item(item)
+    ))
+
 async def _group_pii_by_file(state: OverallState) -> OverallState:
     """ Groups identified PII items by document ID for further processing."""
-    results = {}
+    results = defaultdict(list)
+
+    partial_pii_items = state.get("partial_pii_items", [])
+    prev_pii_count = state.get("prev_pii_count", 0)
+
+    logger.debug("Grouping partially identified PII items by document IDs...")
 
-    logger.debug(f"Grouping partially identified PII items by document IDs...")
+    for file_id, items in zip(state.get("document_ids", []), partial_pii_items):
+        results[file_id].append(items)
 
-    for file_id, items in zip(state.get("document_ids", []), state.get("partial_pii_items", [])):
-        results.setdefault(file_id, []).append(items)
+    results = dict(results)
 
-    logger.info(f"Grouped partially identified PII items by document IDs: {results}")
+    logger.info("Grouped partially identified PII items for %d documents", len(results))
+    logger.debug("Grouped partially identified PII items by document IDs: %s", results)
 
-    return {"document_partial_pii_items": results}
+    # Partial results only accumulate, so an unchanged count means the last prompting round found nothing new
+    return {
+        "document_partial_pii_items": results,
+        "document_pii_texts": {file_id: _collect_pii_texts(items) for file_id, items in results.items()},
+        "prev_pii_count": len(partial_pii_items),
+        "new_pii_found": len(partial_pii_items) > prev_pii_count,
+    }
 
 async def _map_file_partial_pii(state: OverallState) -> ReduceState:
+    """Map grouped partial PII items to combine_file_pii_items state, or finish if nothing new was found."""
     sends = []
 
+    if not state.get("new_pii_found", True):
+        logger.info("No new PII items identified in the last prompting round --> Skipping combination and reprompting.")
+        return "postprocess_pii_items"
+
+    collected_pii_items = state.get("collected_pii_items", {})
+
     for file_id, pii_items in state.get('document_partial_pii_items', {}).items():
         sends.append(
             Send("combine_file_pii_items", {
                 "document_id": file_id,
                 "partial_pii_items": pii_items,
-                "collected_pii_items": state.get("collected_pii_items", {}),
+                "collected_pii_items": collected_pii_items,
             })
         )
 
@@ -190,57 +286,58 @@ async def _combine_file_pii_items(state: ReduceState) -> OverallState:
     existing_file_pii = state.get("collected_pii_items", {})
 
     if file_id and pii_items:
-        logger.debug(f"Combining partially identified PII items for document with ID {file_id} into a final list of identified PII...")
+        logger.debug("Combining partially identified PII items for document with ID %s into a final list of identified PII...", file_id)
 
         try:
-            pii_lists = []
-            for pii_item in pii_items:
-                try:
-                    # Try to parse if it's a string
-                    if isinstance(pii_item, str):
-                        parsed_item = json.loads(pii_item)
-                        pii_lists.append(json.dumps(parsed_item))
-                    else:
-                        # Already an object
-                        pii_lists.append(json.dumps(pii_item))
-                except json.JSONDecodeError:
-                    logger.warning(f"Could not parse PII item: {pii_item[:100]}...")
-
-            # Join the items for the prompt
-            joined_lists = '\n'.join(f"- {item}" for item in pii_lists)
-
-            # Generate the prompt and get LLM response
-            prompt = await reduce_prompt.ainvoke({'pii_lists': joined_lists})
-            llm = await get_llm()
-            response = await llm.ainvoke(prompt)
-            content = response.content
-
-            if content.startswith("```json\n") and content.endswith("\n```"):
-                content = content.replace("```json\n", "").replace("\n```", "").strip()
-
-            pii = json.loads(content)
+            if len(pii_items) == 1:
+                # A single chunk result has nothing to merge, so the reduce prompt is skipped
+                pii = pii_items[0]
+            else:
+                # Serialize each parsed list once straight into the prompt buffer;
+                # strings are already JSON and are written as-is
+                buffer = io.StringIO()
+                for index, item in enumerate(pii_items):
+                    if index:
+                        buffer.write('\n')
+                    buffer.write('- ')
+                    buffer.write(item if isinstance(item, str) else orjson.dumps(item).decode())
+
+                joined_lists = buffer.getvalue()
+
+                # Generate the prompt and get LLM response
+                prompt = [system_message, HumanMessage(content=combination_prompt_template.format(pii_lists=joined_lists))]
+                response = await _invoke_llm(prompt)
+                content = strip_json_fence(response.content)
+
+                pii = orjson.loads(content)
+
+            # Keep only well-formed items, so a bad reduce output item cannot break postprocessing
+            if isinstance(pii, list):
+                pii = [item for item in pii if _is_pii_item(item)]
 
             if pii and isinstance(pii, list):
-                combined_pii = json.loads(existing_file_pii.get(file_id, '[]')) + pii
+                combined_pii = existing_file_pii.get(file_id, []) + pii
 
-                results[file_id] = json.dumps(combined_pii)
+                results[file_id] = combined_pii
 
                 logger.info(f"Combined identified PII for document with ID {file_id} into a list of {len(combined_pii)} PII items")
 
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Failed to combine identified PII for document with ID {file_id} into a list of PII items")
         except Exception as e:
             logger.error(f"Failed to combine identified PII for document with ID {file_id} into a list of PII items")
 
     return {'collected_pii_items': results}
 
-async def _should_reprompt(state: OverallState) -> Literal["mask_documents", "postprocess_pii_items"]:
+def _should_reprompt(state: OverallState) -> Literal["mask_documents", "postprocess_pii_items"]:
     """ Determines whether to reprompt based on the current number of prompts."""
-    if REPROMPTING and state.get("n_prompts", 0) < MAX_PROMPTS:
-        logger.info(f"Performed {state.get('n_prompts', 0)} out of {MAX_PROMPTS} requested prompts --> Reprompting for identifying more PII items.")
+    n_prompts = state.get("n_prompts", 0)
+
+    if REPROMPTING and n_prompts < MAX_PROMPTS:
+        logger.info(f"Performed {n_prompts} out of {MAX_PROMPTS} requested prompts --> Reprompting for identifying more PII items.")
         return "mask_documents"
     else:
-        logger.info(f"Reached the maximum number of allowed prompts: {state.get('n_prompts', 0)} out of {MAX_PROMPTS}.")
+        logger.info(f"Reached the maximum number of allowed prompts: {n_prompts} out of {MAX_PROMPTS}.")
         return "postprocess_pii_items"
 
 async def _mask_documents(state: OverallState) -> OverallState:
@@ -256,28 +353,25 @@ async def _mask_documents(state: OverallState) -> OverallState:
     results = {}
 
     files_chunks = state.get('document_chunks', {})
-    files_pii_items = state.get('document_partial_pii_items', {})
+    files_pii_texts = state.get('document_pii_texts', {})
 
-    if files_chunks and files_pii_items:
-        file_ids = set(files_chunks.keys()).union(set(files_pii_items.keys()))
+    if files_chunks and files_pii_texts:
+        # Only documents with both chunks and PII texts can have chunks to mask
+        file_ids = files_chunks.keys() & files_pii_texts.keys()
 
         for file_id in file_ids:
-            # Prepare chunks for the current file
-            chunks = files_chunks.get(file_id, [])
+            # Prepare chunks and PII texts for the current file
+            chunks = files_chunks[file_id]
+            pii_texts = files_pii_texts[file_id]
 
-            # Get PII items for the file, defaulting to an empty list if not found
-            pii_items = files_pii_items.get(file_id, [])
-
-            if chunks and pii_items:
-                pii_list = [item['text'] for item in json.loads(pii_items[0])]
+            if chunks and pii_texts:
+                pii_pattern = build_pii_pattern(pii_texts)
 
                 for chunk_idx, chunk in enumerate(chunks):
-                    needs_masking = await pii_exist_in_text(chunk, pii_list)
-
-                    if needs_masking:
+                    if pii_exist_in_text(chunk, pii_pattern):
                         results.setdefault(file_id, []).append(chunk)
 
-                        logger.debug(f"Chunk {chunk_idx+1} of document {file_id} requires masking before repromting.")
+                        logger.debug("Chunk %d of document %s requires masking before repromting.", chunk_idx+1, file_id)
 
     return {"document_chunks": results}
 
@@ -285,16 +379,21 @@ async def _map_masked_chunks(state: OverallState) -> MaskState:
     """Map masked chunks to the mask_text state."""
     sends = []
 
+    n_prompts = state.get("n_prompts", 0)
     document_chunks = state.get('document_chunks', {})
+    files_pii_texts = state.get('document_pii_texts', {})
 
     for file_id, chunks in document_chunks.items():
+        pii_texts = files_pii_texts.get(file_id, [])
+
         for chunk_index, chunk_content in enumerate(chunks):
             sends.append(
                 Send("mask_text", {
+                    "n_prompts": n_prompts,
                     "document_id": file_id,
                     "chunk_index": chunk_index,
                     "chunk_content": chunk_content,
-                    "pii_items": state.get('document_partial_pii_items', {}).get(file_id, [])
+                    "pii_items": pii_texts
                 })
             )
 
@@ -313,28 +412,30 @@ async def _mask_text(state: MaskState) -> OverallState:
     """
     results = {}
 
+    n_prompts = state.get('n_prompts', 0)
     file_id = state.get('document_id', '')
     chunk_index = state.get('chunk_index', 0)
     text = state.get('chunk_content', '')
     pii_items = state.get('pii_items', [])
 
     if file_id and text and pii_items:
-        pii_list = [item['text'] for item in json.loads(pii_items[0])]
-
-        logger.debug(f"Masking chunk {chunk_index} of document {file_id}: {text[:100]}...")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Masking chunk %d of document %s: %s...", chunk_index, file_id, text[:100])
 
         # Create a new masked version of the text (fixing the replacement issue)
-        masked_text = await mask_text_with_normalization(text, pii_list)
+        masked_text = mask_text_with_normalization(text, pii_items)
 
         results.update({
             "masked_chunks": [{
+                "n_prompts": n_prompts,
                 "file_id": file_id,
                 "chunk_index": chunk_index,
                 "content": masked_text
             }]
         })
 
-        logger.debug(f"Masked chunk {chunk_index} of document {file_id}: {masked_text[:100]}...")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Masked chunk %d of document %s: %s...", chunk_index, file_id, masked_text[:100])
 
     # Return with masked chunk that will update the document collection
     return results
@@ -343,21 +444,41 @@ async def _collect_masked_chunks(state: OverallState) -> OverallState:
     """ Collects masked document chunks and increments the n_prompts counter."""
     results = {}
 
+    n_prompts = state.get("n_prompts", 0)
     document_chunks = state.get('document_chunks', {})
     masked_chunks = state.get('masked_chunks', [])
 
     # If we have a new masked chunk, update our collection
     if document_chunks and masked_chunks:
-        logger.debug(f"Grouping masked document chunks by document ID...")
+        logger.debug("Grouping masked document chunks by document ID...")
+
+        # Index the masked chunks by document ID, so each document is visited once.
+        # masked_chunks accumulates over all rounds, and the chunk indices of earlier
+        # rounds refer to chunk lists that have since been narrowed, so only the
+        # entries of the current round are applied
+        file_masked_chunks = defaultdict(list)
+
+        for entry in masked_chunks:
+            if entry.get('n_prompts', 0) == n_prompts:
+                file_masked_chunks[entry.get('file_id', '')].append(entry)
+
+        # Return fresh chunk lists for the changed documents only; the
+        # operator.or_ reducer keeps the others and the lists already held in
+        # the graph state are never mutated in place
+        updated_chunks = {}
+
+        for file_id, entries in file_masked_chunks.items():
+            if file_id not in document_chunks:
+                continue
 
-        for file_id in document_chunks.keys():
-            for entry in masked_chunks:
-                if file_id == entry.get('file_id', ''):
-                    document_chunks[file_id][entry.get('chunk_index', 0)] = entry.get('content', '')
+            chunks = updated_chunks[file_id] = list(document_chunks[file_id])
+
+            for entry in entries:
+                chunks[entry.get('chunk_index', 0)] = entry.get('content', '')
 
         # Always set these values to ensure consistent state structure
         results.update({
-            "document_chunks": document_chunks,
+            "document_chunks": updated_chunks,
         })
 
         logger.info(f"Grouped masked document chunks by document ID...")
@@ -372,19 +493,11 @@ async def _postprocess_pii_items(state: OverallState) -> OutputState:
 
     # Access the correct key from the state
     collected_items = state.get('collected_pii_items', {})
-    logger.debug(f"Collected items: {collected_items}")
+    logger.debug("Collected items: %s", collected_items)
 
-    for file_id, pii_items in collected_items.items():
+    for file_id, parsed_items in collected_items.items():
         try:
-            logger.debug(f"Postprocessing final PII items for document with ID {file_id}...")
-
-            # Handle both string and already parsed objects
-            if isinstance(pii_items, str):
-                parsed_items = json.loads(pii_items)
-            else:
-                parsed_items = pii_items
-
-            logger.debug(f"Parsed PII items type: {type(parsed_items)}")
+            logger.debug("Postprocessing final PII items for document with ID %s...", file_id)
 
             # Remove duplicates based on 'text' and 'category' fields
             unique_items = set()
@@ -392,14 +505,17 @@ async def _postprocess_pii_items(state: OverallState) -> OutputState:
 
             for item in parsed_items:
                 # Create a hashable key from the 'text' and 'category' fields
-                item_key = f"{item.get('text', '')}_{item.get('category', '')}"
+                item_key = (item.get('text', ''), item.get('category', ''))
+
+                # Skip items we have already seen before inspecting their text
+                if item_key in unique_items:
+                    continue
+
+                unique_items.add(item_key)
 
-                # Only add items we haven't seen before
-                if item_key not in unique_items:
-                    if '****' not in item.get('text', ''):
-                        # Exclude masked and empty items
-                        unique_items.add(item_key)
-                        unique_pii_items.append(item)
+                # Exclude items whose text was masked before reprompting
+                if _MASK_MARKER not in item_key[0]:
+                    unique_pii_items.append(item)
 
             results.append(
                 {
@@ -410,13 +526,11 @@ async def _postprocess_pii_items(state: OverallState) -> OutputState:
 
             logger.info(f"Identified {len(unique_pii_items)} valid unique PII items for document {file_id}")
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Error parsing PII items for document {file_id}: {e}")
         except Exception as e:
             logger.error(f"Error processing PII items for document {file_id}: {e}")
             import traceback
             logger.error(traceback.format_exc())
 
-    logger.debug(f"Final PII result: {results}")
+    logger.debug("Final PII result: %s", results)
 
     return {'final_pii_items': results}
\ No newline at end of file
@@ -4,6 +4,18 @@ import re
 import html
 
 
+# Patterns used to clean up document content, compiled once at import time
+_RE_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+_RE_TAG = re.compile(r'<[^>]+>')
+_RE_SPACES = re.compile(r' +')
+_RE_NEWLINES = re.compile(r'\n{3,}')
+_RE_DOT_COLON = re.compile(r'([a-zA-Zα-ωΑ-Ω])\.\s+:')
+_RE_SPACE_PUNCT = re.compile(r' ([.,:])')
+# Every line boundary str.splitlines recognises, so they all end up as '\n'
+_RE_LINE_BREAKS = re.compile(r'\r\n|[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+_RE_TRAILING_SPACES = re.compile(r'[^\S\n]+$', re.MULTILINE)
+
+
 class OIFile:
     '''
     This is a class for representing a user-uploaded document
@@ -40,37 +52,35 @@ class OIFile:
         if text_content:
             text = text_content
 
-            # Step 1: Remove HTML comments
-            text = re.sub(r'<!--.*?-->', '', text, flags=re.DOTALL)
-
-            # Step 2: Remove HTML comments (duplicate step in original code)
-            text = re.sub(r'<!--.*?-->', '', text, flags=re.DOTALL)
+            # Step 1: Remove HTML comments first, so a comment inside a tag cannot cut the tag short
+            text = _RE_COMMENT.sub('', text)
 
-            # Step 3: Remove HTML tags
-            text = re.sub(r'<[^>]+>', '', text)
+            # Step 2: Remove HTML tags
+            text = _RE_TAG.sub('', text)
 
-            # Step 4: Decode HTML entities like &nbsp;
+            # Step 3: Decode HTML entities like &nbsp;
             text = html.unescape(text)
 
-            # Step 5: Fix spacing issues
+            # Step 4: Fix spacing issues
             # Normalize multiple spaces
-            text = re.sub(r' +', ' ', text)
+            text = _RE_SPACES.sub(' ', text)
 
             # Normalize newlines (no more than two consecutive)
-            text = re.sub(r'\n{3,}', '\n\n', text)
+            text = _RE_NEWLINES.sub('\n\n', text)
 
-            # Step 6: Fix specific layout issues from the document
+            # Step 5: Fix specific layout issues from the document
             # Fix broken lines that should be together (like "Αριθμός Γ.Ε.ΜΗ .: 180526838000")
-            text = re.sub(r'([a-zA-Zα-ωΑ-Ω])\.\s+:', r'\1.:', text)
+            text = _RE_DOT_COLON.sub(r'\1.:', text)
 
-            # Step 7: Remove extra spaces before punctuation
-            text = re.sub(r' ([.,:])', r'\1', text)
+            # Step 6: Remove extra spaces before punctuation
+            text = _RE_SPACE_PUNCT.sub(r'\1', text)
 
             # Clean up trailing whitespace on each line
-            text = '\n'.join(line.rstrip() for line in text.splitlines())
+            text = _RE_LINE_BREAKS.sub('\n', text)
+            text = _RE_TRAILING_SPACES.sub('', text)
 
             # Clean up whitespaces at the beginning and ending of each string
-            text.strip()
+            text = text.strip()
 
         return text
 
@@ -22,11 +22,11 @@ builder.add_conditional_edges(START, _map_input, ["load_document"])
 builder.add_conditional_edges("load_document", _map_documents_to_split, "split_document")
 builder.add_conditional_edges("split_document", _map_chunks, ["identify_pii_items"])
 builder.add_edge("identify_pii_items", "group_pii_by_file")
-builder.add_conditional_edges("group_pii_by_file", _map_file_partial_pii, ["combine_file_pii_items"])
+builder.add_conditional_edges("group_pii_by_file", _map_file_partial_pii, ["combine_file_pii_items", "postprocess_pii_items"])
 builder.add_conditional_edges("combine_file_pii_items", _should_reprompt, ["mask_documents", "postprocess_pii_items"])
 builder.add_conditional_edges("mask_documents", _map_masked_chunks, ["mask_text"])
 builder.add_edge("mask_text", "collect_masked_chunks")
-builder.add_conditional_edges("collect_masked_chunks", _map_chunks, ["identify_pii_items"])
+builder.add_conditional_edges("collect_masked_chunks", _map_chunks, ["identify_pii_items", "postprocess_pii_items"])
 builder.add_edge("postprocess_pii_items", END)
 
 # Compile the graph
@@ -1,4 +1,4 @@
-from langchain.prompts import ChatPromptTemplate
+from langchain_core.messages import SystemMessage
 
 
 system_prompt = '''
@@ -62,16 +62,5 @@ Output result in structured JSON array format, where each object in the array re
 '''
 
 
-map_prompt = ChatPromptTemplate.from_messages(
-    [
-        ("system", system_prompt),
-        ("human", user_prompt_template),
-    ]
-)
-
-reduce_prompt  = ChatPromptTemplate.from_messages(
-    [
-        ("system", system_prompt),
-        ("human", combination_prompt_template),
-    ]
-)
\ No newline at end of file
+# The system message is static, so it is built once and sent as the fixed prefix of every request
+system_message = SystemMessage(content=system_prompt)
@@ -14,10 +14,14 @@ class OverallState(TypedDict):
     documents: Annotated[List[OIFile], operator.add]
     document_chunks: Annotated[Dict[str, List[str]], operator.or_]
     document_ids: Annotated[List[str], operator.add]
-    partial_pii_items: Annotated[List[str], operator.add]
-    document_partial_pii_items: Dict[str, List[str]]
-    collected_pii_items: Annotated[Dict[str, str], operator.or_]
-    masked_chunks: Annotated[List[Dict[str, str]], operator.add]
+    partial_pii_items: Annotated[List[List[Dict[str, Any]]], operator.add]
+    document_partial_pii_items: Dict[str, List[List[Dict[str, Any]]]]
+    document_pii_texts: Dict[str, List[str]]
+    prev_pii_count: int
+    new_pii_found: bool
+    collected_pii_items: Annotated[Dict[str, List[Dict[str, Any]]], operator.or_]
+    masked_chunks: Annotated[List[Dict[str, Any]], operator.add]
+    prompted_chunks: Annotated[List[str], operator.add]
 
 class OutputState(TypedDict):
     """Output state for the PII detection process, containing the final detected PII items."""
@@ -33,13 +37,14 @@ class SplitState(TypedDict):
     document: OIFile
 
 class DetectState(TypedDict):
-    """State for the detect node that contains a document and a list of PII items to detect in the document content."""
+    """State for the detect node that contains a batch of chunks and, for each chunk, the IDs of the documents that contain it."""
     n_prompts: int
-    document_id: str
-    content: str
+    document_ids: List[List[str]]
+    contents: List[str]
 
 class MaskState(TypedDict):
-    """State for the mask node that contains an document and a list of PII items to mask in the document content."""
+    """State for the mask node that contains an document and the texts of the PII items to mask in the document content."""
+    n_prompts: int
     document_id: str
     chunk_index: int
     chunk_content: str
@@ -48,5 +53,5 @@ class MaskState(TypedDict):
 class ReduceState(TypedDict):
     """State for the reduce node that contains a list of PII items to be combined."""
     document_id: str
-    partial_pii_items: List[str]
-    collected_pii_items: Dict[str, str]
\ No newline at end of file
+    partial_pii_items: List[List[Dict[str, Any]]]
+    collected_pii_items: Dict[str, List[Dict[str, Any]]]
\ No newline at end of file
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import AzureChatOpenAI
 import asyncio
@@ -5,80 +6,91 @@ import logging
 import re
 import unicodedata
 
-from src.config import AZURE_OPENAI_MODEL_NAME, AZURE_OPENAI_API_VERSION, CHUNK_OVERLAP, CHUNK_SIZE
+from src.config import AZURE_OPENAI_MODEL_NAME, AZURE_OPENAI_API_VERSION, CHUNK_OVERLAP, CHUNK_SIZE, MAX_RETRIES
 from src.oifile import OIFile
 
 
-# Initialize global variables for logger and LLM
-logger = None
-llm = None
+# Runs of newlines inside a chunk, collapsed to a single space
+_RE_NEWLINES = re.compile(r'\n+')
+
+# Separators tried by the text splitter, from the coarsest to the finest
+_SEPARATORS = ("\n\n", "\n", ". ", "! ", "? ", "; ", ": ", ", ", "... ", " ", "")
 
 
 # Setup the AzureChatOpenAI LLM
-async def get_llm():
-    """Get the LLM for the langgraph agent."""
-    global llm
-
-    if not llm:
-        llm = AzureChatOpenAI(
-            model=AZURE_OPENAI_MODEL_NAME,
-            api_version=AZURE_OPENAI_API_VERSION,
-            temperature=0.1,
-        )
-    return llm
+@lru_cache(maxsize=1)
+def get_llm() -> AzureChatOpenAI:
+    """
+    Get the LLM for the langgraph agent.
 
+    The client is created on first use and memoized for the lifetime of the
+    process, so every node shares one instance and its HTTP connection pool.
+    """
+    return AzureChatOpenAI(
+        model=AZURE_OPENAI_MODEL_NAME,
+        api_version=AZURE_OPENAI_API_VERSION,
+        temperature=0.1,
+        max_retries=MAX_RETRIES,
+    )
+
+@lru_cache(maxsize=None)
 def get_logger(name: str="pii-detector-map-reduce") -> logging.Logger:
     """
     Get a logger with the specified name. If no handlers are set, it will create a default StreamHandler.
 
+    Loggers are configured once per name and memoized, so repeated calls are cheap.
+
     Args:
         name (str): The name of the logger. Defaults to "pii-detector-map-reduce".
 
     Returns:
         logging.Logger: The configured logger instance.
     """
-    global logger
-
-    if not logger:
-        # Validate the logger name
-        if not isinstance(name, str) or not name.strip():
-            raise ValueError("Logger name must be a non-empty string.")
+    # Validate the logger name
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("Logger name must be a non-empty string.")
+
+    # Get or create a logger with the specified name
+    logger = logging.getLogger(name)
+
+    # Ensure the logger is not already configured
+    if not logger.hasHandlers():
+        # If the logger does not have handlers, we will set it up
+        handler = logging.StreamHandler()
+        formatter = logging.Formatter(
+            fmt="%(asctime)s %(levelname)s %(name)s: %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S"
+        )
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
 
-        # Get or create a logger with the specified name
-        logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
 
-        # Ensure the logger is not already configured
-        if not logger.hasHandlers():
-            # If the logger does not have handlers, we will set it up
-            handler = logging.StreamHandler()
-            formatter = logging.Formatter(
-                fmt="%(asctime)s %(levelname)s %(name)s: %(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S"
-            )
-            handler.setFormatter(formatter)
-            logger.addHandler(handler)
+    return logger
 
-        logger.setLevel(logging.DEBUG)
+@lru_cache(maxsize=16)
+def _get_splitter(chunk_size: int, chunk_overlap: int, separators: tuple[str, ...] = _SEPARATORS) -> RecursiveCharacterTextSplitter:
+    """
+    Get a text splitter for the given chunk parameters.
 
-    return logger
+    Splitters are memoized, so documents chunked with the same parameters share one instance.
+    """
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=list(separators),
+        is_separator_regex=False
+    )
 
 async def chunk_document(
     document: OIFile,
     chunk_size: int = CHUNK_SIZE,
     chunk_overlap: int = CHUNK_OVERLAP,
+    separators: tuple[str, ...] = _SEPARATORS,
 ) -> tuple:
     """Asynchronously chunk documents in parallel with limited concurrency"""
     logger = get_logger()
 
-    # Create text splitter in a thread to avoid blocking
-    def create_splitter_and_split_text(text: str) -> tuple:
-        return tuple(RecursiveCharacterTextSplitter(
-            chunk_size=1024,
-            chunk_overlap=128,
-            separators=["\n\n", "\n", ". ", "! ", "? ", "; ", ": ", ", ", "... ", " ", ""],
-            is_separator_regex=False
-        ).split_text(text))
-
     # Validate parameters
     if chunk_size <= 0 or chunk_overlap < 0 or chunk_overlap >= chunk_size:
         logger.error(f"Invalid chunk parameters: size={chunk_size}, overlap={chunk_overlap}")
@@ -95,16 +107,13 @@ async def chunk_document(
 
     if len(text) < chunk_size:
         logger.warning(f"Document '{name}' is shorter than chunk size. No chunking applied.")
-        return tuple(text)
-
-    # Initialize the return value
-    split_docs = []
+        return (text,)
 
     logger.info(f"Chunking document '{name}' with length {len(text)} characters")
 
-    # Process the text
-    split_docs = await asyncio.to_thread(create_splitter_and_split_text, text)
-    split_docs = [re.sub(r'\n+', ' ', doc.strip()) for doc in split_docs if doc.strip()]
+    # Process the text in a thread to avoid blocking
+    split_docs = await asyncio.to_thread(_get_splitter(chunk_size, chunk_overlap, separators).split_text, text)
+    split_docs = tuple(_RE_NEWLINES.sub(' ', doc) for doc in map(str.strip, split_docs) if doc)
 
     num_chunks = len(split_docs)
     if num_chunks == 0:
@@ -112,38 +121,135 @@ async def chunk_document(
     else:
         logger.info(f"Split '{name}' into {num_chunks} chunks")
 
-    return tuple(split_docs)
+    return split_docs
 
-async def _normalize_and_strip(text):
-    text = unicodedata.normalize('NFKD', text)
-    text = ''.join(c for c in text if not unicodedata.combining(c))
-    return text
+_JSON_FENCE_PREFIX = "```json\n"
+_FENCE_PREFIX = "```\n"
+_FENCE_SUFFIX = "\n```"
 
-async def pii_exist_in_text(
-    text: str,
+def strip_json_fence(content: str) -> str:
+    """Remove the ```json ... ``` (or bare ``` ... ```) markdown fence that LLMs often wrap around JSON responses."""
+    if content.endswith(_FENCE_SUFFIX):
+        if content.startswith(_JSON_FENCE_PREFIX):
+            return content[len(_JSON_FENCE_PREFIX):-len(_FENCE_SUFFIX)].strip()
+        if content.startswith(_FENCE_PREFIX):
+            return content[len(_FENCE_PREFIX):-len(_FENCE_SUFFIX)].strip()
+    return content
+
+class _FoldTable(dict):
+    """
+    A `str.translate` table mapping each codepoint to its NFKD form without combining marks.
+
+    Entries are computed the first time a codepoint is seen. Combining marks are the only
+    characters NFKD reorders, so folding codepoint by codepoint gives the same result as
+    normalizing the whole string.
+    """
+    def __missing__(self, codepoint: int) -> str:
+        folded = ''.join(c for c in unicodedata.normalize('NFKD', chr(codepoint)) if not unicodedata.combining(c))
+        self[codepoint] = folded
+        return folded
+
+_FOLD_TABLE = _FoldTable()
+
+def _normalize_and_strip(text):
+    # ASCII text has no accents or compatibility characters to fold
+    if text.isascii():
+        return text
+    return text.translate(_FOLD_TABLE)
+
+@lru_cache(maxsize=128)
+def _compile_alternation(patterns: frozenset[str], overlapping: bool = False) -> re.Pattern | None:
+    """
+    Compile literal strings into a single longest-first alternation regex.
+
+    With `overlapping` the alternation is wrapped in a lookahead, so `finditer` reports
+    the longest match starting at every position instead of skipping past each match.
+    """
+    patterns = [p for p in patterns if p]
+
+    if not patterns:
+        return None
+
+    alternation = '|'.join(map(re.escape, sorted(patterns, key=len, reverse=True)))
+
+    if overlapping:
+        alternation = f'(?=({alternation}))'
+
+    return re.compile(alternation)
+
+@lru_cache(maxsize=256)
+def _prepare_pii(pii_items: frozenset[str], case_insensitive: bool, normalize: bool) -> frozenset[str]:
+    """Normalize and casefold a set of PII items once, however many chunks are checked against them."""
+    if normalize:
+        pii_items = map(_normalize_and_strip, pii_items)
+
+    if case_insensitive:
+        pii_items = map(str.casefold, pii_items)
+
+    return frozenset(pii_items)
+
+def _normalize_with_map(text: str) -> tuple[str, list[int] | None]:
+    """
+    Normalize text like `_normalize_and_strip` and map each normalized character back to the text.
+
+    `offsets[i]` is the index in `text` of the character that produced the i-th normalized
+    character, followed by a final `len(text)` entry. ASCII text is left as is and gets
+    `None` offsets, since its indices map one to one.
+    """
+    if text.isascii():
+        return text, None
+
+    parts = []
+    offsets = []
+    for index, char in enumerate(text):
+        folded = _FOLD_TABLE[ord(char)]
+        parts.append(folded)
+        offsets.extend([index] * len(folded))
+    offsets.append(len(text))
+
+    return ''.join(parts), offsets
+
+def build_pii_pattern(
     pii_items: list[str],
     case_insensitive: bool = True,
     normalize: bool = True,
+) -> re.Pattern | None:
+    """
+    Compile PII items into one pattern so a chunk is scanned once regardless of the number of items.
+
+    Args:
+        pii_items (list[str]): The PII item texts to look for.
+        case_insensitive (bool): Whether the items should be casefolded.
+        normalize (bool): Whether accents should be stripped from the items.
+
+    Returns:
+        re.Pattern | None: The compiled pattern, or None if there are no non-empty items.
+    """
+    return _compile_alternation(_prepare_pii(frozenset(pii_items), case_insensitive, normalize))
+
+def pii_exist_in_text(
+    text: str,
+    pii_pattern: re.Pattern | None,
+    case_insensitive: bool = True,
+    normalize: bool = True,
 ) -> bool:
-    """Check if any PII items exist in the text."""
+    """Check if any PII items exist in the text, using a pattern built by `build_pii_pattern` with the same flags."""
     logger = get_logger()
 
-    if not text or not pii_items:
+    if not text or not pii_pattern:
         logger.debug("No text or PII items provided for existence check.")
         return False
 
     if normalize:
         # Normalize text to remove accents and case differences
-        text = await _normalize_and_strip(text)
-        pii_items = [await _normalize_and_strip(pii) for pii in pii_items]
+        text = _normalize_and_strip(text)
 
     # Normalize text for case-insensitive comparison
     if case_insensitive:
         text = text.casefold()
-        pii_items = [pii.casefold() for pii in pii_items]
 
     # Check for any PII item in the text
-    exists = any(pii in text for pii in pii_items)
+    exists = pii_pattern.search(text) is not None
 
     if exists:
         logger.debug("At least one identified PII item found in the chunk.")
@@ -152,30 +258,31 @@ async def pii_exist_in_text(
 
     return exists
 
-async def mask_text_with_normalization(text, pii_items):
+def mask_text_with_normalization(text, pii_items):
     """
     Replace all substrings in `text` whose normalized form matches any normalized PII item.
     """
     if not pii_items:
         return text
 
-    # Build a list of (start, end) indices to mask
+    # The pattern is shared by every chunk masked with the same PII items
+    pattern = _compile_alternation(_prepare_pii(frozenset(pii_items), False, True), overlapping=True)
+    if pattern is None:
+        return text
+
+    # Build a list of (start, end) indices to mask in a single pass over the text
     mask_ranges = []
-    norm_text = await _normalize_and_strip(text)
-    for pii in pii_items:
-        norm_pii = await _normalize_and_strip(pii)
-        # Find all matches of norm_pii in norm_text
-        start = 0
-        while True:
-            idx = norm_text.find(norm_pii, start)
-            if idx == -1:
-                break
-            # Map back to original text indices
-            orig_sub = text[idx:idx+len(pii)]
-            # Only mask if the normalized original substring matches norm_pii
-            if await _normalize_and_strip(orig_sub) == norm_pii:
-                mask_ranges.append((idx, idx+len(pii)))
-            start = idx + 1
+    norm_text, offsets = _normalize_with_map(text)
+    for match in pattern.finditer(norm_text):
+        start = match.start()
+        end = start + len(match.group(1))
+
+        if offsets is not None:
+            # Map back to original text indices, covering any combining marks
+            # dropped after the last matched character
+            start, end = offsets[start], max(offsets[end], offsets[end - 1] + 1)
+
+        mask_ranges.append((start, end))
 
     # Merge overlapping ranges
     mask_ranges.sort()
@@ -1,14 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from langchain_community.document_loaders import PyPDFLoader
-from langchain_docling import DoclingLoader
-from typing import Any, Dict, List, Optional
+from typing import IO, Any, AsyncIterator, Dict, Iterator, List, Optional
+from xml.etree import ElementTree
 import asyncio
 import mimetypes
+import mmap
 import os
 import pypandoc
+import zipfile
 
 from logger import get_logger
 
 
+try:
+    # Run the synchronous wrapper on uvloop when it is installed
+    import uvloop
+    _loop_factory = uvloop.new_event_loop
+except ImportError:
+    _loop_factory = None
+
+
+_DOCX_MIME = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+# Tags of the WordprocessingML elements that carry the text of a DOCX document
+_WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_WORD_PARAGRAPH = f'{_WORD_NS}p'
+_WORD_TEXT = f'{_WORD_NS}t'
+_WORD_TAB = f'{_WORD_NS}tab'
+_WORD_BREAKS = frozenset({f'{_WORD_NS}br', f'{_WORD_NS}cr'})
+
+# MIME types of known file signatures, keyed by the first bytes of the file
+_SIGNATURE_LENGTH = 4
+_SIGNATURES = {
+    b'%PDF': 'application/pdf',
+    b'\x50\x4B\x03\x04': 'application/zip',  # ZIP signature (docx, xlsx)
+}
+
+# Configure acceptable mimetypes once at import time
+mimetypes.init()
+mimetypes.add_type(_DOCX_MIME, '.docx')
+mimetypes.add_type('application/pdf', '.pdf')
+mimetypes.add_type('text/plain', '.txt')
+mimetypes.add_type('text/markdown', '.md')
+mimetypes.add_type('application/rtf', '.rtf')
+mimetypes.add_type('application/vnd.oasis.opendocument.text', '.odt')
+
+# Pool that runs the file jobs of every loader call, sized for ingest rather
+# than sharing the loop's general purpose default executor
+_INGEST_WORKERS = max(1, int(os.environ.get("PII_INGEST_WORKERS", "16")))
+_EXECUTOR = ThreadPoolExecutor(max_workers=_INGEST_WORKERS, thread_name_prefix="filesystem_loader")
+
 def load_local_documents(
     dir_path: str,
     recursive: bool = False,
@@ -18,25 +60,18 @@ def load_local_documents(
     max_concurrency: int = 10
 ) -> List[Dict[str, Any]]:
     """
-    Synchronous wrapper for load_local_documents_async.
+    Synchronous wrapper for aload_local_documents.
+
+    Must be called from synchronous code; async callers should await
+    aload_local_documents directly.
     """
-    try:
-        # Try to use the current event loop if running in async context
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            raise RuntimeError("Event loop is already running")
-        return loop.run_until_complete(
-            load_local_documents_async(dir_path, recursive, file_extensions,
-                                       max_file_size_mb, sort_by, max_concurrency)
-        )
-    except RuntimeError:
-        # If no event loop exists or it's already running, create a new one
-        return asyncio.run(
-            load_local_documents_async(dir_path, recursive, file_extensions,
-                                       max_file_size_mb, sort_by, max_concurrency)
+    with asyncio.Runner(loop_factory=_loop_factory) as runner:
+        return runner.run(
+            aload_local_documents(dir_path, recursive, file_extensions,
+                                  max_file_size_mb, sort_by, max_concurrency)
         )
 
-async def load_local_documents_async(
+async def aload_local_documents(
     dir_path: str,
     recursive: bool = False,
     file_extensions: Optional[List[str]] = None,
@@ -50,7 +85,7 @@ async def load_local_documents_async(
 
     Args:
         dir_path (str): Path to the directory containing documents
-        max_concurrency (int): Maximum number of files to process concurrently
+        max_concurrency (int): Maximum number of files to process concurrently, capped at PII_INGEST_WORKERS
         recursive (bool): Whether to scan subdirectories recursively
         file_extensions (List[str], optional): List of file extensions to include (e.g. ['.pdf', '.docx'])
         max_file_size_mb (float, optional): Maximum file size in MB to process
@@ -59,110 +94,172 @@ async def load_local_documents_async(
     Returns:
         list: List of dictionaries containing document data
     """
+    results = [
+        doc_data async for doc_data in iter_local_documents(
+            dir_path, recursive, file_extensions, max_file_size_mb, sort_by, max_concurrency
+        )
+    ]
+
+    # Documents are yielded as they complete, and their IDs follow the sorted file order
+    results.sort(key=lambda doc_data: int(doc_data["file"]["id"]))
+
+    return results
+
+async def iter_local_documents(
+    dir_path: str,
+    recursive: bool = False,
+    file_extensions: Optional[List[str]] = None,
+    max_file_size_mb: Optional[float] = None,
+    sort_by: str = "name",  # Options: "name", "size", "modified"
+    max_concurrency: int = 10
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Asynchronously load documents from a local directory, yielding each document as soon as it is processed.
+
+    Takes the same arguments as aload_local_documents. Documents are yielded in completion
+    order, and at most max_concurrency processed documents wait for the caller at any time,
+    so memory use does not grow with the size of the directory. Callers that may stop early
+    should wrap the iterator in contextlib.aclosing, so pending files are cancelled promptly.
+    Raises ValueError if max_concurrency is less than 1.
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+
     logger = get_logger("test_agent")
 
     # Resolve directory
     if not os.path.isabs(dir_path):
         dir_path = os.path.join(os.getcwd(), dir_path)
 
-    if not os.path.exists(dir_path) or not os.path.isdir(dir_path):
-        logger.warning(f"Directory not found: {dir_path}")
-        return []
+    if not os.path.isdir(dir_path):
+        logger.warning("Directory not found: %s", dir_path)
+        return
 
-    # Find all files
-    file_paths = []
-    if recursive:
-        for root, _, files in os.walk(dir_path):
-            for file in files:
-                file_paths.append(os.path.join(root, file))
-    else:
-        file_paths = [
-            os.path.join(dir_path, f) for f in os.listdir(dir_path)
-            if os.path.isfile(os.path.join(dir_path, f))
-        ]
+    # Find all files as (path, name, extension, size, modified) tuples, so each
+    # file is only stat-ed once and its name is only split once
+    files = []
+    pending_dirs = [dir_path]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        try:
+            entries = os.scandir(current_dir)
+        except OSError as e:
+            # Skip unreadable directories, like os.walk does
+            logger.warning("Skipping directory %s: %s", current_dir, e)
+            continue
+
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        extension = os.path.splitext(entry.name)[1].lower()
+                        files.append((entry.path, entry.name, extension, stat.st_size, stat.st_mtime))
+                    elif recursive and entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(entry.path)
+                except OSError as e:
+                    # e.g. a file deleted during the scan; only this entry is skipped
+                    logger.warning("Skipping %s: %s", entry.path, e)
 
     # Apply extension filter if specified
     if file_extensions:
         file_extensions = [ext.lower() if ext.startswith('.') else f'.{ext.lower()}' for ext in file_extensions]
-        file_paths = [f for f in file_paths if os.path.splitext(f)[1].lower() in file_extensions]
+        files = [f for f in files if f[2] in file_extensions]
 
     # Apply size filter if specified
     if max_file_size_mb:
         max_bytes = max_file_size_mb * 1024 * 1024
-        file_paths = [f for f in file_paths if os.path.getsize(f) <= max_bytes]
+        files = [f for f in files if f[3] <= max_bytes]
 
-    if not file_paths:
-        logger.warning(f"No matching files found in directory: {dir_path}")
-        return []
+    if not files:
+        logger.warning("No matching files found in directory: %s", dir_path)
+        return
 
     # Sort files
     if sort_by == "name":
-        file_paths.sort()
+        files.sort()
     elif sort_by == "size":
-        file_paths.sort(key=os.path.getsize)
+        files.sort(key=lambda f: f[3])
     elif sort_by == "modified":
-        file_paths.sort(key=os.path.getmtime)
+        files.sort(key=lambda f: f[4])
 
     # Define process file function with better error handling
-    async def _process_file(idx: int, file_path: str, semaphore: asyncio.Semaphore):
+    async def _process_file(idx: int, file_path: str, filename: str, extension: str, file_size: int):
         try:
-            async with semaphore:
-                logger.debug(f"Processing file {idx+1}/{len(file_paths)}: {file_path}")
-
-                # Skip files that are too large
-                if max_file_size_mb and os.path.getsize(file_path) > max_file_size_mb * 1024 * 1024:
-                    logger.warning(f"Skipping file {file_path}: exceeds size limit of {max_file_size_mb}MB")
-                    return None
-
-                # Get document data with timeout protection
-                try:
-                    async with asyncio.timeout(30):  # 30 second timeout per file
-                        doc_data = await get_document_data(file_path, file_id=str(idx))
-                        return doc_data
-                except asyncio.TimeoutError:
-                    logger.error(f"Timeout while processing file {file_path}")
-                    return None
+            logger.debug("Processing file %d/%d: %s", idx + 1, len(files), file_path)
+
+            # Get document data with timeout protection
+            try:
+                async with asyncio.timeout(30):  # 30 second timeout per file
+                    # Load and extract each file in one worker-thread job
+                    doc_data = await loop.run_in_executor(
+                        _EXECUTOR, get_document_data, file_path, str(idx), filename, file_size, extension
+                    )
+                    return doc_data
+            except asyncio.TimeoutError:
+                logger.error("Timeout while processing file %s", file_path)
+                return None
 
         except Exception as e:
-            logger.error(f"Error processing file {file_path}: {str(e)}")
+            logger.error("Error processing file %s: %s", file_path, e)
             return None
 
-    # Process files in chunks to avoid memory issues with large directories
-    semaphore = asyncio.Semaphore(max_concurrency)
-    results = []
-    chunk_size = min(100, len(file_paths))  # Process up to 100 files at a time
-
-    for i in range(0, len(file_paths), chunk_size):
-        chunk = file_paths[i:i+chunk_size]
-        tasks = [_process_file(i+j, path, semaphore) for j, path in enumerate(chunk)]
-        chunk_results = await asyncio.gather(*tasks)
-        results.extend([r for r in chunk_results if r])
-        logger.debug(f"Processed {i+len(chunk)}/{len(file_paths)} files")
-
-    logger.info(f"Successfully processed {len(results)}/{len(file_paths)} files from {dir_path}")
-    return results
-
-async def get_document_data(file_path: str, file_id: Optional[str] = None) -> Dict[str, Any]:
+    # Feed the file jobs to the module pool from at most as many consumer tasks as
+    # it has workers; each consumer only submits its next file once its previous
+    # one is done. The pool is shared, so a file can still wait in its queue behind
+    # other loader calls or behind jobs that outlived their timeout, and that wait
+    # counts against the per-file timeout
+    loop = asyncio.get_running_loop()
+    pending_files = iter(enumerate(files))
+    processed = asyncio.Queue(maxsize=max_concurrency)
+    processed_count = 0
+
+    async def _consume():
+        for idx, (file_path, filename, extension, file_size, _) in pending_files:
+            await processed.put(await _process_file(idx, file_path, filename, extension, file_size))
+
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(min(max_concurrency, _INGEST_WORKERS, len(files))):
+            tg.create_task(_consume())
+
+        # Every file puts exactly one result, None if it could not be processed
+        for _ in range(len(files)):
+            doc_data = await processed.get()
+            if doc_data:
+                processed_count += 1
+                yield doc_data
+
+    logger.info("Successfully processed %d/%d files from %s", processed_count, len(files), dir_path)
+
+def get_document_data(
+    file_path: str,
+    file_id: Optional[str] = None,
+    filename: Optional[str] = None,
+    file_size: Optional[int] = None,
+    extension: Optional[str] = None,
+) -> Dict[str, Any]:
     """
     Get both metadata and content for a document file.
 
     Args:
         file_path (str): Path to the file
         file_id (str, optional): ID to assign to the file
+        filename (str, optional): Name of the file, if already known from the directory listing
+        file_size (int, optional): Size of the file in bytes, if already known from the directory listing
+        extension (str, optional): Lowercase extension of the file, if already known from the directory listing
 
     Returns:
         Dict[str, Any]: Dictionary containing file metadata and content
     """
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File not found: {file_path}")
-
     # Extract content
-    content = await extract_file_content(file_path)
+    content = extract_file_content(file_path, extension)
 
-    # Get metadata
-    filename = os.path.basename(file_path)
-    mime_type = await get_file_mime_type(file_path)
-    file_size = os.path.getsize(file_path)
+    # Get metadata, reusing what the directory listing already provided
+    if filename is None:
+        filename = os.path.basename(file_path)
+    mime_type = get_file_mime_type(file_path, extension)
+    if file_size is None:
+        file_size = os.path.getsize(file_path)
 
     # Simulate the information structure of the files in Open WebUI
     return {
@@ -180,127 +277,144 @@ async def get_document_data(file_path: str, file_id: Optional[str] = None) -> Di
     }
 
 # Main function to extract file content based on type
-async def extract_file_content(file_path: str) -> str:
+def extract_file_content(file_path: str, extension: Optional[str] = None) -> str:
     """
     Extract content from a file based on its extension.
 
     Args:
         file_path (str): Path to the file
+        extension (str, optional): Lowercase extension of the file, derived from the path if not given
 
     Returns:
         str: Extracted text content
     """
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File not found: {file_path}")
-
     # Get file extension in lowercase
-    extension = os.path.splitext(file_path)[1].lower()
-
-    # Map extensions to handler functions
-    handlers = {
-        '.txt': read_text_file,
-        '.md': read_markdown_file,
-        '.docx': read_docx_file,
-        '.pdf': read_pdf_file,
-        '.rtf': read_rtf_file,
-        '.odt': read_odt_file
-    }
+    if extension is None:
+        extension = os.path.splitext(file_path)[1].lower()
+
+    handler = _HANDLERS.get(extension)
 
-    if extension in handlers:
-        return await handlers[extension](file_path)
+    if handler:
+        return handler(file_path)
     else:
         raise ValueError(f"Unsupported file format: {extension}")
 
 # File MIME type detection
-async def get_file_mime_type(file_path: str) -> str:
+def get_file_mime_type(file_path: str, extension: Optional[str] = None) -> str:
     """
     Get the MIME type of a file.
 
     Args:
         file_path (str): Path to the file
+        extension (str, optional): Lowercase extension of the file, derived from the path if not given
 
     Returns:
         str: MIME type of the file
     """
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File not found: {file_path}")
-
-    if not mimetypes.inited:
-        # Configure acceptable mimetypes
-        mimetypes.init()
-        mimetypes.add_type('application/vnd.openxmlformats-officedocument.wordprocessingml.document', '.docx')
-        mimetypes.add_type('application/pdf', '.pdf')
-        mimetypes.add_type('text/plain', '.txt')
-        mimetypes.add_type('text/markdown', '.md')
-        mimetypes.add_type('application/rtf', '.rtf')
-        mimetypes.add_type('application/vnd.oasis.opendocument.text', '.odt')
+    if extension is None:
+        extension = os.path.splitext(file_path)[1].lower()
 
     # Get mime type based on file extension
-    mime_type, _ = mimetypes.guess_type(file_path)
+    mime_type = _guess_mime_type(extension)
 
     # Fallback if mime type couldn't be determined
     if not mime_type:
         # Check file signature
-        file_start = await read_file_start(file_path)
+        mime_type = _SIGNATURES.get(read_file_start(file_path, _SIGNATURE_LENGTH), 'application/octet-stream')
 
-        if file_start.startswith(b'%PDF'):
-            return 'application/pdf'
-        elif file_start.startswith(b'\x50\x4B\x03\x04'):  # ZIP signature (docx, xlsx)
-            if file_path.endswith('.docx'):
-                return 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+        # DOCX files are ZIP archives
+        if mime_type == 'application/zip' and extension == '.docx':
+            return _DOCX_MIME
 
-        return 'application/octet-stream'
+        return mime_type
 
     return mime_type
 
-async def read_file_start(file_path: str, bytes_to_read: int = 512) -> bytes:
-    """Read the first bytes of a file to determine its type."""
-    def _read(path: str, size: int) -> bytes:
-        with open(path, 'rb') as f:
-            return f.read(size)
+@lru_cache(maxsize=None)
+def _guess_mime_type(extension: str) -> Optional[str]:
+    """Guess the MIME type for a file extension, memoized since the lookup only depends on the extension."""
+    mime_type, _ = mimetypes.guess_type(f'file{extension}')
+    return mime_type
 
-    return await asyncio.to_thread(_read, file_path, bytes_to_read)
+def read_file_start(file_path: str, bytes_to_read: int = 512) -> bytes:
+    """Read the first bytes of a file to determine its type."""
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        return os.read(fd, bytes_to_read)
+    finally:
+        os.close(fd)
 
 # Content readers for different file types
-async def read_text_file(file_path: str) -> str:
+def read_text_file(file_path: str) -> str:
     """Read content from a plain text file."""
-    def _read(path: str) -> str:
-        with open(path, 'r', encoding='utf-8') as f:
-            return f.read()
-
-    return await asyncio.to_thread(_read, file_path)
+    with open(file_path, 'rb') as f:
+        # mmap cannot map an empty file
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
 
-async def read_markdown_file(file_path: str) -> str:
-    """Read content from a markdown file."""
-    # For basic markdown files, we can treat them as text
-    return await read_text_file(file_path)
+        # Decode straight from the mapped pages, without copying them into a bytes object first
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            text = str(mm, 'utf-8', 'replace')
 
-async def read_docx_file(file_path: str) -> str:
-    """Extract text from DOCX file using DoclingLoader."""
-    def _read_with_docling(path: str) -> str:
-        documents = DoclingLoader(file_path=path).load()
-        return '\n'.join([d.page_content for d in documents])
+    # Translate newlines like text mode does
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
 
-    return await asyncio.to_thread(_read_with_docling, file_path)
+    return text
 
-async def read_pdf_file(file_path: str) -> str:
+def read_markdown_file(file_path: str) -> str:
+    """Read content from a markdown file."""
+    # For basic markdown files, we can treat them as text
+    return read_text_file(file_path)
+
+def _iter_docx_paragraphs(document_xml: IO[bytes]) -> Iterator[str]:
+    """Yield the text of each paragraph in a DOCX document XML stream, in document order."""
+    runs = []
+
+    for _, element in ElementTree.iterparse(document_xml):
+        tag = element.tag
+
+        if tag == _WORD_TEXT:
+            runs.append(element.text or '')
+        elif tag == _WORD_TAB:
+            runs.append('\t')
+        elif tag in _WORD_BREAKS:
+            runs.append('\n')
+        elif tag == _WORD_PARAGRAPH:
+            yield ''.join(runs)
+            runs.clear()
+            # Free the parsed paragraph, so only one paragraph is held in memory
+            element.clear()
+
+def read_docx_file(file_path: str) -> str:
+    """Extract text from DOCX file by streaming the paragraphs of its document XML."""
+    with zipfile.ZipFile(file_path) as archive, archive.open('word/document.xml') as document_xml:
+        return '\n'.join(_iter_docx_paragraphs(document_xml))
+
+def read_pdf_file(file_path: str) -> str:
     """Extract text from PDF file using PyPDFLoader."""
-    def _read_with_pypdf(path: str) -> str:
-        documents = PyPDFLoader(path).load()
-        return '\n'.join([d.page_content for d in documents])
-
-    return await asyncio.to_thread(_read_with_pypdf, file_path)
+    return '\n'.join(d.page_content for d in PyPDFLoader(file_path).lazy_load())
 
-async def read_rtf_file(file_path: str) -> str:
+def read_rtf_file(file_path: str) -> str:
     """Extract text from RTF file using pypandoc."""
     try:
-        return await asyncio.to_thread(pypandoc.convert_file, file_path, "plain")
+        return pypandoc.convert_file(file_path, "plain", format="rtf", verify_format=False)
     except ImportError:
         raise ImportError("pypandoc is required for reading RTF files. Install it with 'pip install pypandoc'.")
 
-async def read_odt_file(file_path: str) -> str:
+def read_odt_file(file_path: str) -> str:
     """Extract text from ODT file using pypandoc."""
     try:
-        return await asyncio.to_thread(pypandoc.convert_file, file_path, "plain")
+        return pypandoc.convert_file(file_path, "plain", format="odt", verify_format=False)
     except ImportError:
-        raise ImportError("pypandoc is required for reading ODT files. Install it with 'pip install pypandoc'.")
\ No newline at end of file
+        raise ImportError("pypandoc is required for reading ODT files. Install it with 'pip install pypandoc'.")
+
+# Map extensions to handler functions, built once after all readers are defined
+_HANDLERS = {
+    '.txt': read_text_file,
+    '.md': read_markdown_file,
+    '.docx': read_docx_file,
+    '.pdf': read_pdf_file,
+    '.rtf': read_rtf_file,
+    '.odt': read_odt_file
+}
@@ -8,7 +8,7 @@ to evaluate extraction quality, response consistency, and server stability.
 
 Usage:
 1. Install required packages:
-   pip install asyncio langchain-community langchain-docling langgraph-sdk pypandoc
+   pip install asyncio langchain-community langgraph-sdk pypandoc
 
 2. Set your deployment and local file system paths.
 
@@ -37,7 +37,7 @@ import sys
 import time
 import uuid
 
-from filesystem_loader import load_local_documents
+from filesystem_loader import aload_local_documents
 from logger import get_logger
 
 
@@ -47,12 +47,17 @@ async def test_client(url: str, port: int, api_key: str, files: List[Dict[str, A
 
     deployment_url = f"http://{url}:{port}"
 
-    logger.info(f"Sending {len(files)} files to the LangGraph deployment URL {deployment_url}:")
+    logger.info("Sending %d files to the LangGraph deployment URL %s:", len(files), deployment_url)
     for file in files:
-        logger.info(f"- File {file.get('file', {}).get('id', '0')}: {file.get('file', {}).get('filename', 'Unknown')} ({file.get('file', {}).get('meta', {}).get('content_type', 'Unknown')})")
+        logger.info(
+            "- File %s: %s (%s)",
+            file.get('file', {}).get('id', '0'),
+            file.get('file', {}).get('filename', 'Unknown'),
+            file.get('file', {}).get('meta', {}).get('content_type', 'Unknown'),
+        )
 
     import json
-    print(json.dumps(test_files, indent=2))
+    print(json.dumps(files, indent=2))
 
     try:
         client = None
@@ -85,9 +90,9 @@ async def test_client(url: str, port: int, api_key: str, files: List[Dict[str, A
             # Calculate and display response time
             duration = time.time() - start_time
             logger.info("✅ Synchronous client completed successfully")
-            logger.info(f"Response time: {duration:.2f} seconds")
+            logger.info("Response time: %.2f seconds", duration)
             logger.info(100*"=")
-            logger.info("Result:", full_response)
+            logger.info("Result: %s", full_response)
             logger.info(100*"=")
         else:
             print("Using asynchronous client")
@@ -122,11 +127,25 @@ async def test_client(url: str, port: int, api_key: str, files: List[Dict[str, A
             print(100*"=")
 
     except Exception as e:
-        logger.info(f"❌ Test failed: {e}")
+        logger.info("❌ Test failed: %s", e)
         return False
 
     return True
 
+async def main(args: argparse.Namespace):
+    """Load the test documents and send them to the agent, on a single event loop"""
+    test_files = await aload_local_documents(args.directory)
+
+    if args.files:
+        test_files = [file for file in test_files if file.get("file", {}).get("filename", "") in args.files]
+
+    if not test_files:
+        sys.exit(f"No test files found in directory {args.directory}.")
+
+    logger.info("Found %d test files", len(test_files))
+
+    await test_client(args.address, args.port, args.key, test_files, syncronous=args.synchronous, threadless=args.threadless)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='PII Detection LangGraph Agent Test Script')
     parser.add_argument("-a", "--address", help="LangGraph server's IP address", type=str, default="127.0.0.1")
@@ -147,16 +166,6 @@ if __name__ == "__main__":
     if not os.path.exists(args.directory) or not os.path.isdir(args.directory):
         sys.exit(f"Wrong path to directory with documents: {args.directory}")
 
-    test_files = load_local_documents(args.directory)
-
-    if args.files:
-        test_files = [file for file in test_files if file.get("file", {}).get("filename", "") in args.files]
-
-    if not test_files:
-        sys.exit(f"No test files found in directory {args.directory}.")
-
     logger = get_logger("test_agent")
 
-    logger.info(f"Found {len(test_files)} test files")
-
-    asyncio.run(test_client(args.address, args.port, args.key, test_files, syncronous=args.synchronous, threadless=args.threadless))
\ No newline at end of file
+    asyncio.run(main(args))
\ No newline at end of file